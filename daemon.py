@@ -0,0 +1,271 @@
+"""
+daemon.py
+
+Helpers used when spider.py is run as a long lived process ('spider.py daemon')
+
+Holds the per subreddit poll schedule, watches the configuration files for
+changes, downloads in background threads so slow hosts don't stall the crawl,
+and serves a small JSON status report on a local port.
+"""
+
+import collections
+import heapq
+import http.server
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+
+log = logging
+
+# Polling a sub more often than this would only hammer the Reddit API
+MIN_POLL_INTERVAL = 60
+
+
+class PollScheduler():
+    """Keeps subreddits ordered by when they are next due to be polled"""
+
+    def __init__(self, jitter=0):
+        self.jitter = jitter
+        self._queue = []
+        self._intervals = {}
+        self._last_polled = {}
+        self._lock = threading.Lock()
+
+    def _jitter(self):
+        return random.uniform(0, self.jitter) if self.jitter > 0 else 0
+
+    def update(self, schedule, now=None):
+        """Replaces the schedule with the given {subreddit: interval} mapping
+
+        Subreddits that were already scheduled keep their due time, unless
+        their new interval would have them due sooner. New subreddits are
+        staggered across the jitter window so they aren't all polled at once.
+        Raises ValueError if any interval is below MIN_POLL_INTERVAL.
+        """
+        now = time.time() if now is None else now
+
+        for name, interval in schedule.items():
+            if interval < MIN_POLL_INTERVAL:
+                msg = "Poll interval {} for '{}' is below the minimum of {}"
+                raise ValueError(msg.format(interval, name, MIN_POLL_INTERVAL))
+
+        with self._lock:
+            known = {name: due for due, name in self._queue}
+            self._intervals = dict(schedule)
+            self._queue = []
+
+            for name, interval in self._intervals.items():
+                if name in known:
+                    due = min(known[name], now + interval)
+                else:
+                    due = now + self._jitter()
+                self._queue.append((due, name))
+
+            heapq.heapify(self._queue)
+
+        log.debug("Scheduled {} subreddits".format(len(self._intervals)))
+
+    def pop_due(self, now=None):
+        """Returns the next subreddit that is due, or None if none are"""
+        now = time.time() if now is None else now
+
+        with self._lock:
+            if self._queue and self._queue[0][0] <= now:
+                due, name = heapq.heappop(self._queue)
+                return name
+
+        return None
+
+    def reschedule(self, name, now=None):
+        now = time.time() if now is None else now
+
+        with self._lock:
+            self._last_polled[name] = now
+            if name not in self._intervals:
+                log.debug("Subreddit '{}' was unscheduled".format(name))
+                return
+
+            due = now + self._intervals[name] + self._jitter()
+            heapq.heappush(self._queue, (due, name))
+
+        msg = "Subreddit '{}' is next due in {:.0f} seconds"
+        log.debug(msg.format(name, due - now))
+
+    def seconds_until_next(self, now=None):
+        now = time.time() if now is None else now
+
+        with self._lock:
+            if not self._queue:
+                return float('inf')
+            return max(0, self._queue[0][0] - now)
+
+    def snapshot(self, now=None):
+        now = time.time() if now is None else now
+
+        with self._lock:
+            due = sum(1 for when, name in self._queue if when <= now)
+            subreddits = {name: {'interval': self._intervals[name],
+                                 'next_poll_in': round(when - now, 1),
+                                 'last_polled': self._last_polled.get(name)}
+                          for when, name in self._queue}
+
+        return {'scheduled': len(subreddits),
+                'due': due,
+                'subreddits': subreddits}
+
+
+class FileWatcher():
+    """Reports when any of the watched files has been modified"""
+
+    def __init__(self, *paths):
+        self._mtimes = {}
+        self.watch(*paths)
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def watch(self, *paths):
+        for path in paths:
+            if path not in self._mtimes:
+                self._mtimes[path] = self._mtime(path)
+
+    def changed(self):
+        changed = []
+        for path, mtime in self._mtimes.items():
+            current = self._mtime(path)
+            if current != mtime:
+                self._mtimes[path] = current
+                changed.append(path)
+
+        if changed:
+            log.info("Detected changes to: {}".format(', '.join(changed)))
+        return changed
+
+
+class DaemonStats():
+    """Thread safe counters and download throughput for the status report"""
+
+    window = 300
+
+    def __init__(self):
+        self.started = time.time()
+        self._counters = collections.Counter()
+        self._recent = collections.deque()
+        self._lock = threading.Lock()
+
+    def increment(self, counter, amount=1):
+        with self._lock:
+            self._counters[counter] += amount
+
+    def record_download(self, succeeded, skipped=False):
+        now = time.time()
+
+        with self._lock:
+            if succeeded:
+                self._counters['downloads_succeeded'] += 1
+                self._recent.append(now)
+            elif skipped:
+                self._counters['downloads_collided'] += 1
+            else:
+                self._counters['downloads_failed'] += 1
+
+            while self._recent and self._recent[0] < now - self.window:
+                self._recent.popleft()
+
+    def snapshot(self):
+        now = time.time()
+
+        with self._lock:
+            while self._recent and self._recent[0] < now - self.window:
+                self._recent.popleft()
+            counters = dict(self._counters)
+            recent = len(self._recent)
+
+        uptime = now - self.started
+        succeeded = counters.get('downloads_succeeded', 0)
+        window = min(self.window, uptime) or 1
+        return {'started': self.started,
+                'uptime': round(uptime, 1),
+                'counters': counters,
+                'throughput': {
+                    'downloads_per_minute': round(
+                        succeeded / (uptime or 1) * 60, 2),
+                    'recent_downloads_per_minute': round(
+                        recent / window * 60, 2)}}
+
+
+class DownloadWorker(threading.Thread):
+    """Pulls Downloadables off a queue so the crawl never waits on a host
+
+    If given, `failed` is called with each Downloadable that fails to
+    download, but not with those skipped as colliding names.
+    """
+
+    def __init__(self, downloads, stats, failed=None):
+        super().__init__(name='download-worker', daemon=True)
+        self.downloads = downloads
+        self.stats = stats
+        self.failed = failed
+
+    def run(self):
+        while True:
+            downloadable = self.downloads.get()
+            log.info("Downloading from URL: {}".format(downloadable.url))
+
+            try:
+                succeeded = downloadable.pull()
+            except Exception:
+                msg = "Unexpected error downloading from URL: {}"
+                log.exception(msg.format(downloadable.url))
+                succeeded = False
+
+            self.stats.record_download(succeeded, downloadable.skipped)
+            if not succeeded and not downloadable.skipped and self.failed:
+                self.failed(downloadable)
+            self.downloads.task_done()
+
+
+class _StatusHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/status'):
+            self.send_error(404)
+            return
+
+        body = json.dumps(self.server.report(), indent=2).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("Status request: {}".format(format % args))
+
+
+class StatusServer(threading.Thread):
+    """Serves the result of `report()` as JSON on a local HTTP port"""
+
+    def __init__(self, report, host='127.0.0.1', port=8765):
+        super().__init__(name='status-server', daemon=True)
+        self._server = http.server.HTTPServer((host, port), _StatusHandler)
+        self._server.report = report
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def run(self):
+        log.info("Serving status on http://{}:{}/status".format(*self.address))
+        self._server.serve_forever()
+
+    def shutdown(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -7,6 +7,7 @@ import urllib
 import imgurpython
 import requests
 
+import utils
 from utils import Downloadable
 
 
@@ -22,8 +23,27 @@ class SourceManager():
     _config = None
 
     @classmethod
-    def _configure(cls, *args, **kwargs):
-        raise NotImplementedError()
+    def _read_settings(cls, config):
+        """Returns the manager's settings from config, raising if invalid"""
+        return {}
+
+    @classmethod
+    def _apply_config(cls, config):
+        settings = cls._read_settings(config)
+        cls._config = config
+        cls._configured = True
+
+        for name, value in settings.items():
+            setattr(cls, name, value)
+
+    @classmethod
+    def _configure(cls, config_file):
+        log.debug("Configuring the {}".format(cls.__name__))
+        config = configparser.ConfigParser()
+        with open(config_file) as stream:
+            config.read_file(stream)
+
+        cls._apply_config(config)
 
     @classmethod
     def _connect(cls, *args, **kwargs):
@@ -68,20 +88,9 @@ class DirectLinkManager(SourceManager):
             self._configure(CONFIG_FILE)
 
     @classmethod
-    def _configure(cls, config_file):
-        cls._configured = True
-
-        if cls._config is None:
-            cls._config = configparser.ConfigParser()
-
-        log.debug("Configuring the DirectLinkManager")
-
-        with open(config_file) as stream:
-            cls._config.read_file(stream)
-            extensions = cls._config.get(cls.source_name,
-                                         'AcceptedExtensions')
-
-        cls.accepted_extensions = extensions.split(',')
+    def _read_settings(cls, config):
+        extensions = config.get(cls.source_name, 'AcceptedExtensions')
+        return {'accepted_extensions': extensions.split(',')}
 
     @classmethod
     def match_source(cls, url):
@@ -122,21 +131,19 @@ class ImgurManager(SourceManager):
             self._connect()
 
     @classmethod
-    def _configure(cls, config_file):
-        cls._configured = True
+    def _read_settings(cls, config):
+        user = config.get(cls.source_name, 'Username', fallback='')
+        password = config.get(cls.source_name, 'Password', fallback='')
+        return {'credentials': {'user': user, 'pass': password}}
 
-        if cls._config is None:
-            cls._config = configparser.ConfigParser()
-        else:
-            return
+    @classmethod
+    def _apply_config(cls, config):
+        old_credentials = getattr(cls, 'credentials', None)
+        super()._apply_config(config)
 
-        with open(config_file) as stream:
-            cls._config.read_file(stream)
-            user = cls._config.get(cls.source_name, 'Username', fallback='')
-            password = cls._config.get(cls.source_name,
-                                       'Password',
-                                       fallback='')
-        cls.credentials = {'user': user, 'pass': password}
+        if old_credentials not in (None, cls.credentials):
+            log.info("Imgur credentials changed, dropping the old client")
+            cls._client = None
 
     @classmethod
     def _connect(cls):
@@ -147,11 +154,16 @@ class ImgurManager(SourceManager):
 
         if cls._remains is None:
             try:
-                results = requests.get(cls._query_url).json()
+                results = utils._get_session().get(
+                    cls._query_url, timeout=utils.REQUEST_TIMEOUT).json()
                 cls._remains = {'client': results['data']['ClientRemaining'],
                                 'user': results['data']['UserRemaining']}
             except KeyError:
                 import ipdb; ipdb.set_trace()
+            except requests.exceptions.ReadTimeout:
+                log.warning("Timed out querying Imgur credits, will retry")
+            except requests.exceptions.ConnectionError:
+                log.warning("Couldn't connect to query Imgur credits")
 
         cls.connected = True
 
@@ -165,6 +177,10 @@ class ImgurManager(SourceManager):
 
     @classmethod
     def _decrement_query_count(cls):
+        if cls._remains is None:
+            log.debug("Imgur quota is unknown, not decrementing it")
+            return
+
         cls._remains['client'] -= 1
         cls._remains['user'] -= 1
         msg = "Decremented quota: user->{} client->{}"
@@ -247,9 +263,39 @@ class DeviantArtManager(SourceManager):
 
     def downloadables_from_url(self, url):
         encoded = urllib.parse.quote(url, safe="~()*!.'")
-        request = requests.get(self._query_url.format(encoded))
+        try:
+            request = utils._get_session().get(self._query_url.format(encoded),
+                                               timeout=utils.REQUEST_TIMEOUT)
+        except requests.exceptions.ReadTimeout:
+            msg = "Timed out querying DeviantArt for URL: {}"
+            log.warning(msg.format(url))
+            return
+        except requests.exceptions.ConnectionError:
+            msg = "Couldn't connect to DeviantArt for URL: {}"
+            log.warning(msg.format(url))
+            return
+
         link = request.json().get('url')
         log.debug("Yielding Downloadable from URL: {}".format(link))
         yield Downloadable(link) if link else None
 
 managers = (DirectLinkManager, GfycatManager, ImgurManager, DeviantArtManager)
+
+
+def check_config(config):
+    """Raises if config lacks a setting that any manager needs"""
+    for manager in managers:
+        manager._read_settings(config)
+
+
+def reconfigure(config):
+    """Applies config to every manager that has already been configured
+
+    Clients and caches are kept, so a long running process can pick up
+    changes to the config file without paying to reconnect. Check the config
+    with check_config first, so it is never half applied.
+    """
+    for manager in managers:
+        if manager._configured:
+            log.debug("Reconfiguring {}".format(manager.__name__))
+            manager._apply_config(config)
@@ -10,15 +10,33 @@ should be written as only a name. The sub, 'http://reddit.com/r/cute' would be
 written simply as 'cute' with a newline following. A sample list shoule be
 included as 'subs.lst.example'. The images will be dumped to a single flat
 directory, and will be named based on the reddit submission title.
+
+Run as 'spider.py daemon' to keep polling the subs instead of running through
+them once. Each sub is polled every PollInterval seconds from the [daemon]
+section of the config, or on its own interval when one follows its name in
+the list ('cute 600'). Images are downloaded by DownloadWorkers threads, and
+a JSON status report is served on StatusPort.
+
+Crawling and downloading can also be run separately. 'spider.py plan' writes
+every image it would download to a JSON lines plan file, and 'spider.py
+execute' downloads a plan concurrently. Executing skips images that have
+already been saved, so it can be resumed, and --start/--stop select a range of
+plan lines so several executors can share one plan.
 """
 
+import argparse
+import configparser
 import functools
 import logging
+import os
+import queue
 import sys
+import time
 
 import praw
 import requests
 
+import daemon
 import source_managers
 import utils
 
@@ -35,12 +53,21 @@ __status__ = 'Prototype'
 APP_NAME = 'imagespider'
 CONFIG_PATH = 'config.ini'
 REDDIT = praw.Reddit(user_agent=APP_NAME)
+MODES = ('crawl', 'daemon', 'plan', 'execute')
+PLAN_PATH = 'plan.jsonl'
+WATCH_INTERVAL = 5
+LOG_LEVELS = {'debug': logging.DEBUG,
+              'info': logging.INFO,
+              'warning': logging.WARNING,
+              'error': logging.ERROR,
+              'critical': logging.CRITICAL}
 
 log = logging
 
 
 @functools.lru_cache(maxsize=100)
 def _get_highest_score_from_subreddit(hashable_subreddit):
+    # Failures raise rather than return so lru_cache never keeps them
     sub = hashable_subreddit
     err = "There was a problem querying the API, assuming score is too low"
 
@@ -49,16 +76,16 @@ def _get_highest_score_from_subreddit(hashable_subreddit):
         score = top_scoring_submission.score
     except praw.errors.HTTPException:
         log.error(err)
-        return False
+        raise utils.RequestFailed(err)
     except praw.errors.InvalidSubreddit:
         log.error(err)
-        return False
+        raise utils.RequestFailed(err)
     except requests.exceptions.ReadTimeout:
         log.error(err)
-        return False
+        raise utils.RequestFailed(err)
     except requests.exceptions.ConnectionError:
         log.error(err)
-        return False
+        raise utils.RequestFailed(err)
 
     msg = "Highest score in sub, '{}' is {}"
     log.debug(msg.format(sub.display_name, score))
@@ -71,7 +98,14 @@ def _absolute_comparator(submission, minimum):
 
 def _relative_comparator(submission, minimum):
     hashed_subreddit = utils.HashableSubredditWrapper(submission.subreddit)
-    top_score = _get_highest_score_from_subreddit(hashed_subreddit)
+    try:
+        top_score = _get_highest_score_from_subreddit(hashed_subreddit)
+    except utils.RequestFailed:
+        return False
+
+    if top_score <= 0:
+        log.info("Highest score in sub is {}, skipping it".format(top_score))
+        return False
 
     relative_score = submission.score / top_score * 100
     msg = "Relative score is {}, highest score in sub is {}"
@@ -145,10 +179,39 @@ def _get_submissions_from_subreddit(subreddit, func_name, limit):
             break
 
 
-def _get_sub_list(path):
+def _get_sub_entries(path):
     with open(path) as sub_list:
-        for sub in (x.strip() for x in sub_list if not x.startswith('#')):
-            yield sub
+        for line in (x.strip() for x in sub_list if not x.startswith('#')):
+            if line:
+                yield line.split()
+
+
+def _get_sub_list(path):
+    for entry in _get_sub_entries(path):
+        yield entry[0]
+
+
+def _get_sub_schedule(path, default_interval):
+    """Maps each sub to its poll interval in seconds
+
+    A sub may be followed by its own interval on the same line, e.g. 'cute 600'
+    """
+    msg = "Invalid interval '{}' for sub '{}', using default"
+    schedule = {}
+    for entry in _get_sub_entries(path):
+        name, interval = entry[0], default_interval
+        if len(entry) > 1:
+            try:
+                interval = int(entry[1])
+            except ValueError:
+                log.warning(msg.format(entry[1], name))
+                interval = default_interval
+
+            if interval < daemon.MIN_POLL_INTERVAL:
+                log.warning(msg.format(entry[1], name))
+                interval = default_interval
+        schedule[name] = interval
+    return schedule
 
 
 def submissions_from_subreddit(subreddit_name,
@@ -182,20 +245,54 @@ def downloadables_from_submission(submission):
             return
 
 
-if __name__ == '__main__':
-    config = utils.get_config(CONFIG_PATH)
-    levels = {'debug': logging.DEBUG,
-              'info': logging.INFO,
-              'warning': logging.WARNING,
-              'error': logging.ERROR,
-              'critical': logging.CRITICAL}
+def downloadables_from_subreddit(subreddit_name,
+                                 score_is_sufficient,
+                                 score_minimum,
+                                 seen=None):
+    """Yields the Downloadables of every sufficiently scored submission
+
+    If a set is passed as `seen`, submissions whose ids are in it are skipped
+    and the ids of submissions that produced Downloadables are added to it.
+    """
+    for submission in submissions_from_subreddit(subreddit_name):
+        if not score_is_sufficient(submission, score_minimum):
+            msg = ("Insufficient score on submission, skipping "
+                   "submission '{}' and all remaining submissions "
+                   "in subreddit: {}")
+            log.info(msg.format(submission.title, subreddit_name))
+            break
+
+        if seen is not None and submission.id in seen:
+            msg = "Already processed submission '{}', skipping it"
+            log.debug(msg.format(submission.title))
+            continue
+
+        downloadables = [x for x in downloadables_from_submission(submission)
+                         if x is not None]
+
+        # Marked before yielding, so a download that fails and unmarks the
+        # submission can't be undone by marking it afterwards
+        if seen is not None and downloadables:
+            seen.add(submission.id)
+
+        for downloadable in downloadables:
+            downloadable.subreddit = submission.subreddit.display_name
+            downloadable.submission_id = submission.id
+            yield downloadable
+
+
+def _configure_logging(config):
+    global log
+
     level_from_config = config.get('DEFAULT', 'LogLevel', fallback='error')
-    selected_level = levels[level_from_config]
+    selected_level = LOG_LEVELS[level_from_config]
     log = utils.get_logger('main', selected_level)
     utils.log = utils.get_logger('utils', selected_level)
     source_managers.log = utils.get_logger('source_managers', selected_level)
+    daemon.log = utils.get_logger('daemon', selected_level)
 
-    sub_list_path = config.get('DEFAULT', 'SubList')
+
+def _get_score_settings(config):
     score_minimum = config.getint('DEFAULT',
                                   'MinimumScore',
                                   fallback=0)
@@ -204,24 +301,265 @@ if __name__ == '__main__':
                                           fallback=False)
 
     if score_is_relative:
-        score_is_sufficient = _relative_comparator
-    else:
-        score_is_sufficient = _absolute_comparator
+        return _relative_comparator, score_minimum
+    return _absolute_comparator, score_minimum
+
+
+def run_crawl(config):
+    sub_list_path = config.get('DEFAULT', 'SubList')
+    score_is_sufficient, score_minimum = _get_score_settings(config)
 
     for subreddit_name in _get_sub_list(sub_list_path):
-        for submission in submissions_from_subreddit(subreddit_name):
-            if not score_is_sufficient(submission, score_minimum):
-                msg = ("Insufficient score on submission, skipping "
-                       "submission '{}' and all remaining submissions "
-                       "in subreddit: {}")
-                log.info(msg.format(submission.title, subreddit_name))
-                break
+        downloadables = downloadables_from_subreddit(subreddit_name,
+                                                     score_is_sufficient,
+                                                     score_minimum)
+        for downloadable in downloadables:
+            log.info("Downloading from URL: {}".format(downloadable.url))
+            downloadable.pull()
+
 
-            downloadables = downloadables_from_submission(submission)
+def run_plan(config, plan_path):
+    sub_list_path = config.get('DEFAULT', 'SubList')
+    score_is_sufficient, score_minimum = _get_score_settings(config)
+    # Each target must belong to one entry, or executing would treat a
+    # different image that was given the same name as already complete
+    targets = set()
+
+    with open(plan_path, 'w') as plan:
+        for subreddit_name in _get_sub_list(sub_list_path):
+            downloadables = downloadables_from_subreddit(subreddit_name,
+                                                         score_is_sufficient,
+                                                         score_minimum)
             for downloadable in downloadables:
-                log.info("Downloading from URL: {}".format(downloadable.url))
-                downloadable.subreddit = submission.subreddit.display_name
-                downloadable.pull()
+                downloadable.unique_filename(targets)
+                utils.write_plan_entry(plan, downloadable)
+
+    log.info("Planned {} downloads in: {}".format(len(targets), plan_path))
+
+
+def run_execute(plan_path, start=0, stop=None, workers=8):
+    """Downloads the entries of a plan that haven't been saved yet"""
+    stats = daemon.DaemonStats()
+    downloads = queue.Queue(maxsize=workers * 2)
+
+    for _ in range(workers):
+        daemon.DownloadWorker(downloads, stats).start()
+
+    plan = utils.read_plan(plan_path, start, stop)
+    try:
+        for line_number, downloadable in plan:
+            if os.path.exists(downloadable.destination):
+                msg = "Plan line {} is already complete: {}"
+                log.debug(msg.format(line_number, downloadable.destination))
+                stats.increment('downloads_complete')
+                continue
+
+            downloads.put(downloadable)
+
+        downloads.join()
+    except KeyboardInterrupt:
+        log.info("Interrupted, finishing the downloads in progress")
+        while True:
+            try:
+                downloads.get_nowait()
+            except queue.Empty:
+                break
+            downloads.task_done()
+
+        downloads.join()
+
+    counters = stats.snapshot()['counters']
+    msg = ("Executed plan: {} downloaded, {} failed, {} already complete, "
+           "{} skipped as colliding names")
+    log.info(msg.format(counters.get('downloads_succeeded', 0),
+                        counters.get('downloads_failed', 0),
+                        counters.get('downloads_complete', 0),
+                        counters.get('downloads_collided', 0)))
+
+
+def _load_daemon_settings(config):
+    """Reads everything the daemon needs from the config, raising on errors
+
+    Nothing is applied here so a broken config can be rejected as a whole.
+    """
+    level = config.get('DEFAULT', 'LogLevel', fallback='error')
+    if level not in LOG_LEVELS:
+        raise ValueError("Unknown LogLevel: {}".format(level))
+
+    utils.Downloadable._read_settings(config)
+    source_managers.check_config(config)
+
+    interval = config.getint('daemon', 'PollInterval', fallback=3600)
+    if interval < daemon.MIN_POLL_INTERVAL:
+        msg = "PollInterval must be at least {} seconds"
+        raise ValueError(msg.format(daemon.MIN_POLL_INTERVAL))
+
+    jitter = config.getint('daemon', 'PollJitter', fallback=300)
+    if jitter < 0:
+        raise ValueError("PollJitter must not be negative")
+
+    workers = config.getint('daemon', 'DownloadWorkers', fallback=4)
+    if workers < 1:
+        raise ValueError("DownloadWorkers must be at least 1")
+
+    sub_list_path = config.get('DEFAULT', 'SubList')
+    return {'score': _get_score_settings(config),
+            'sub_list_path': sub_list_path,
+            'schedule': _get_sub_schedule(sub_list_path, interval),
+            'jitter': jitter,
+            'workers': workers}
+
+
+def run_daemon(config):
+    """Polls each sub on its own interval until interrupted
+
+    The Reddit and Imgur clients, connection pools and caches stay warm
+    between polls, and changes to the config file or sub list are picked up
+    without a restart.
+    """
+    settings = _load_daemon_settings(config)
+    stats = daemon.DaemonStats()
+    downloads = queue.Queue()
+    scheduler = daemon.PollScheduler(settings['jitter'])
+    scheduler.update(settings['schedule'])
+    watcher = daemon.FileWatcher(CONFIG_PATH, settings['sub_list_path'])
+    # Submissions are only crawled once per process to spare the APIs, unless
+    # one of their downloads fails
+    seen = set()
+    workers = []
+
+    def report():
+        status = stats.snapshot()
+        status['queues'] = {'downloads_pending': downloads.qsize(),
+                            'download_workers': len(workers)}
+        status['queues'].update(scheduler.snapshot())
+        return status
+
+    def unmark_failed(downloadable):
+        seen.discard(downloadable.submission_id)
+
+    def add_workers(count):
+        while len(workers) < count:
+            worker = daemon.DownloadWorker(downloads, stats, unmark_failed)
+            worker.start()
+            workers.append(worker)
+
+        if len(workers) > count:
+            msg = ("Running {} download workers, lowering DownloadWorkers "
+                   "takes effect on restart")
+            log.info(msg.format(len(workers)))
+
+    add_workers(settings['workers'])
+
+    status_server = None
+    status_port = config.getint('daemon', 'StatusPort', fallback=8765)
+    if status_port:
+        status_host = config.get('daemon', 'StatusHost', fallback='127.0.0.1')
+        status_server = daemon.StatusServer(report, status_host, status_port)
+        status_server.start()
+
+    try:
+        while True:
+            if watcher.changed():
+                try:
+                    config = utils.get_config(CONFIG_PATH)
+                    settings = _load_daemon_settings(config)
+                except (OSError, KeyError, ValueError,
+                        configparser.Error) as err:
+                    msg = "Failed to reload configuration, keeping it: {}"
+                    log.error(msg.format(err))
+                else:
+                    _configure_logging(config)
+                    utils.Downloadable._configure(config)
+                    source_managers.reconfigure(config)
+                    scheduler.jitter = settings['jitter']
+                    scheduler.update(settings['schedule'])
+                    watcher.watch(settings['sub_list_path'])
+                    add_workers(settings['workers'])
+                    stats.increment('reloads')
+                    log.info("Reloaded configuration")
+
+            subreddit_name = scheduler.pop_due()
+            if subreddit_name is None:
+                time.sleep(min(WATCH_INTERVAL, scheduler.seconds_until_next()))
+                continue
+
+            log.info("Polling subreddit: {}".format(subreddit_name))
+            # Top scores change between polls, look them up again
+            _get_highest_score_from_subreddit.cache_clear()
+            score_is_sufficient, score_minimum = settings['score']
+            try:
+                for downloadable in downloadables_from_subreddit(
+                        subreddit_name, score_is_sufficient,
+                        score_minimum, seen):
+                    downloads.put(downloadable)
+                    stats.increment('downloads_queued')
+            except Exception:
+                msg = "Unexpected error polling subreddit: {}"
+                log.exception(msg.format(subreddit_name))
+                stats.increment('polls_failed')
+            else:
+                stats.increment('polls')
+
+            scheduler.reschedule(subreddit_name)
+    except KeyboardInterrupt:
+        log.info("Interrupted, waiting on {} queued downloads".format(
+            downloads.qsize()))
+        downloads.join()
+    finally:
+        if status_server is not None:
+            status_server.shutdown()
+
+
+def _parse_args(argv=None):
+    description = "Downloads highly rated images from a list of subreddits"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('mode',
+                        nargs='?',
+                        default='crawl',
+                        choices=MODES,
+                        help="'crawl' runs through the sub list once, "
+                             "'daemon' keeps polling it, 'plan' writes what "
+                             "would be downloaded to a plan file and "
+                             "'execute' downloads a plan (default: crawl)")
+    parser.add_argument('--plan-file',
+                        default=PLAN_PATH,
+                        help="plan written by 'plan' and read by 'execute' "
+                             "(default: {})".format(PLAN_PATH))
+    parser.add_argument('--start',
+                        type=int,
+                        default=0,
+                        help="first plan line to execute, counting from 0")
+    parser.add_argument('--stop',
+                        type=int,
+                        default=None,
+                        help="plan line to stop executing at, exclusive")
+    parser.add_argument('--workers',
+                        type=int,
+                        default=8,
+                        help="concurrent downloads when executing a plan")
+    args = parser.parse_args(argv)
+
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.start < 0 or (args.stop is not None and args.stop < args.start):
+        parser.error("--start and --stop must give a valid range of lines")
+    return args
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    config = utils.get_config(CONFIG_PATH)
+    _configure_logging(config)
+
+    if args.mode == 'daemon':
+        run_daemon(config)
+    elif args.mode == 'plan':
+        run_plan(config, args.plan_file)
+    elif args.mode == 'execute':
+        run_execute(args.plan_file, args.start, args.stop, args.workers)
+    else:
+        run_crawl(config)
 
     try:
         log.info("Done processing subreddits")
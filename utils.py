@@ -1,17 +1,30 @@
 import configparser
+import itertools
+import json
 import logging
 import os
 import random
 import re
 import requests
-import shutil
 import sys
 import tempfile
+import threading
 
 
 CONFIG_FILE = 'config.ini'
 log = logging
 
+# Each thread keeps its own session so repeated downloads from the same
+# hosts reuse their connections. requests doesn't promise that one session
+# is safe to share between threads.
+_sessions = threading.local()
+# Seconds to wait on a host before giving up, so a stalled host can't block
+# a download thread forever
+REQUEST_TIMEOUT = 30
+# Held while choosing a destination and moving a download into it, so
+# threads saving images under the same name can't overwrite each other
+_destination_lock = threading.Lock()
+
 
 class RequestFailed(Exception):
     pass
@@ -32,26 +45,37 @@ class Downloadable():
         self.relation_id = self._pattern.sub('', relation_id)
         self._subreddit = None
         self.__safe_filename = None
+        self.skipped = False
+        self.submission_id = None
 
         if self._config is None:
             self._configure()
 
     @classmethod
-    def _configure(cls):
-        log.debug("Configuring Downloadable")
-        cls._config = configparser.ConfigParser()
-        with open(CONFIG_FILE) as configuration:
-            cls._config.read_file(configuration)
-
-        given_destination = cls._config.get('DEFAULT', 'DestinationDirectory')
-        cls.dest_dir = os.path.abspath(given_destination)
-        cls.max_name_length = int(cls._config.get('DEFAULT', 'MaxNameLength'))
-        cls._overwrite = cls._config.getboolean('DEFAULT',
+    def _read_settings(cls, config):
+        """Returns the Downloadable settings from config, raising if invalid"""
+        given_destination = config.get('DEFAULT', 'DestinationDirectory')
+        return {'dest_dir': os.path.abspath(given_destination),
+                'max_name_length': int(config.get('DEFAULT', 'MaxNameLength')),
+                '_overwrite': config.getboolean('DEFAULT',
                                                 'Overwrite',
-                                                fallback=False)
-        cls._skip_collisions = cls._config.getboolean('DEFAULT',
+                                                fallback=False),
+                '_skip_collisions': config.getboolean('DEFAULT',
                                                       'SkipCollidingNames',
-                                                      fallback=False)
+                                                      fallback=False)}
+
+    @classmethod
+    def _configure(cls, config=None):
+        log.debug("Configuring Downloadable")
+        if config is None:
+            config = configparser.ConfigParser()
+            with open(CONFIG_FILE) as configuration:
+                config.read_file(configuration)
+
+        settings = cls._read_settings(config)
+        cls._config = config
+        for name, value in settings.items():
+            setattr(cls, name, value)
 
     def pull(self):
         try:
@@ -60,26 +84,34 @@ class Downloadable():
             log.warning("Failed to download from URL: {}".format(self.url))
             return False
 
-        with tempfile.TemporaryDirectory() as temp:
-            new_copy = os.path.join(temp, self.safe_filename())
+        # Written next to its destination so saving it is an atomic rename,
+        # and an interrupted download is only ever left as a '.part' file
+        handle, new_copy = tempfile.mkstemp(
+            prefix='.{}.'.format(self.safe_filename()),
+            suffix='.part',
+            dir=self.dest_dir)
+        os.close(handle)
+
+        try:
             write_request(request, new_copy)
 
-            local_copy_exists = os.path.exists(self.destination)
-            if local_copy_exists and self._skip_collisions:
-                log.info("Local copy detected, skipping colliding image")
-                return False
-            elif local_copy_exists and self._overwrite:
-                log.info("Local copy detected, overwriting it")
-                old_copy = os.path.join(temp, 'to_delete.tmp')
-                shutil.move(self.destination, old_copy)
-                shutil.move(new_copy, self.destination)
-            elif local_copy_exists:
-                log.info("Local copy detected, creating a unique filename")
-                self.safe_filename(guarantee_unique=True)
-                self.pull()
-            else:
+            with _destination_lock:
+                local_copy_exists = os.path.exists(self.destination)
+                if local_copy_exists and self._skip_collisions:
+                    log.info("Local copy detected, skipping colliding image")
+                    self.skipped = True
+                    return False
+                elif local_copy_exists and self._overwrite:
+                    log.info("Local copy detected, overwriting it")
+                elif local_copy_exists:
+                    log.info("Local copy detected, creating a unique filename")
+                    self.safe_filename(guarantee_unique=True)
+
                 log.debug("Saving image: {}".format(self.destination))
-                shutil.move(new_copy, self.destination)
+                os.replace(new_copy, self.destination)
+        finally:
+            if os.path.exists(new_copy):
+                os.remove(new_copy)
 
         log.debug("Saving successful")
         return True
@@ -115,6 +147,56 @@ class Downloadable():
         self.__safe_filename = filename + extension
         return self.__safe_filename
 
+    def unique_filename(self, taken):
+        """Returns a name not in `taken` and adds it there
+
+        Clashes get a counted suffix ('name-2.jpg') rather than random digits,
+        so the same plan always gives the same names.
+        """
+        filename = self.safe_filename()
+        segment, extension = os.path.splitext(filename)
+        count = 1
+        while filename in taken:
+            count += 1
+            filename = '{}-{}{}'.format(segment, count, extension)
+
+        if filename != self.safe_filename():
+            msg = "Name '{}' was taken, using: {}"
+            log.debug(msg.format(self.safe_filename(), filename))
+
+        taken.add(filename)
+        self.__safe_filename = filename
+        return filename
+
+    def to_plan_entry(self):
+        return {'url': self.url,
+                'subreddit': self.subreddit,
+                'relation_id': self.relation_id,
+                'number': self.number,
+                'target': self.safe_filename()}
+
+    @classmethod
+    def from_plan_entry(cls, entry):
+        """Rebuilds a planned Downloadable, raising ValueError if malformed"""
+        # Plans are plain text, never let one write outside dest_dir
+        target = entry.get('target')
+        target = os.path.basename(target) if isinstance(target, str) else ''
+        if not isinstance(entry.get('url'), str) or not target:
+            raise ValueError("Plan entries need a url and a target")
+
+        for field in ('subreddit', 'relation_id'):
+            if not isinstance(entry.get(field, ''), str):
+                raise ValueError("Plan entry {} must be text".format(field))
+
+        number = entry.get('number')
+        downloadable = cls(entry['url'],
+                           number=number if number != '' else None,
+                           relation_id=entry.get('relation_id', ''))
+        if entry.get('subreddit'):
+            downloadable.subreddit = entry['subreddit']
+        downloadable.__safe_filename = target
+        return downloadable
+
     @property
     def destination(self):
         return os.path.join(self.dest_dir, self.safe_filename())
@@ -150,6 +232,9 @@ class HashableSubredditWrapper():
 def get_logger(name=__name__, level=log.ERROR):
     logger = logging.getLogger(name)
     logger.setLevel(level)
+    if logger.handlers:
+        return logger
+
     handler = logging.StreamHandler(sys.stdout)
     format_str = '%(asctime)s - %(levelname)s - %(message)s (in:%(funcName)s)'
     formatter = logging.Formatter(format_str)
@@ -165,10 +250,18 @@ def get_config(path):
     return config
 
 
-def make_request(url):
+def _get_session():
+    session = getattr(_sessions, 'session', None)
+    if session is None:
+        log.debug("Opening a requests session for this thread")
+        session = _sessions.session = requests.Session()
+    return session
+
+
+def make_request(url, timeout=REQUEST_TIMEOUT):
     log.debug("Requesting URL: {}".format(url))
     try:
-        request = requests.get(url)
+        request = _get_session().get(url, timeout=timeout)
     except requests.exceptions.ConnectionError:
         msg = "Failed to connect to URL: {}".format(url)
         log.error(msg)
@@ -192,3 +285,30 @@ def write_request(request, destination, chunk_size=1024):
         for chunk in request.iter_content(chunk_size):
             stream.write(chunk)
     log.debug("Writing successful")
+
+
+def write_plan_entry(stream, downloadable):
+    entry = downloadable.to_plan_entry()
+    log.debug("Planning download of '{}' as: {}".format(entry['url'],
+                                                      entry['target']))
+    stream.write(json.dumps(entry, separators=(',', ':')) + '\n')
+
+
+def read_plan(path, start=0, stop=None):
+    """Yields (line number, Downloadable) for lines start to stop of a plan
+
+    Line numbers count from zero and stop is exclusive, so a plan can be
+    split into shards by giving each executor its own range.
+    """
+    with open(path) as stream:
+        lines = itertools.islice(enumerate(stream), start, stop)
+        for line_number, line in lines:
+            if not line.strip():
+                continue
+
+            try:
+                entry = json.loads(line)
+                yield line_number, Downloadable.from_plan_entry(entry)
+            except (ValueError, KeyError, TypeError, AttributeError):
+                msg = "Skipping malformed plan entry on line {}"
+                log.warning(msg.format(line_number))